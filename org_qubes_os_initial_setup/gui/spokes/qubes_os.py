@@ -28,6 +28,7 @@ from org_qubes_os_initial_setup.utils import CamelCaseWrap
 _ = lambda x: x
 N_ = lambda x: x
 
+import json
 import os
 import subprocess
 import logging
@@ -37,91 +38,131 @@ gi.require_version("Gtk", "3.0")
 gi.require_version("Gdk", "3.0")
 gi.require_version("GLib", "2.0")
 
-from gi.repository import Gtk
+from gi.repository import GLib, Gtk
 from pyanaconda.ui.categories.system import SystemCategory
+from pyanaconda.ui.communication import hubQ
 from pyanaconda.ui.gui.spokes import NormalSpoke
 from pyanaconda.ui.common import FirstbootOnlySpokeMixIn
 from org_qubes_os_initial_setup.constants import QUBES_INITIAL_SETUP
 
 # export only the spoke, no helper functions, classes or constants
 __all__ = ["QubesOsSpoke"]
-choices_instances = []
+
+# where to persist the parsed 'lvs' output between Initial Setup runs
+LVM_CACHE_PATH = "/run/qubes-initial-setup/lvm_cache.json"
 
 
 class QubesChoiceBase:
-    def __init__(self, widget, location, indent=False, dependencies=None):
+    def __init__(self, widget, location, indent=False, dependencies=None, registry=None):
         self.widget = widget
         self.location = location
         self.indent = indent
+        # per-spoke list of choices; lives only as long as the spoke, so
+        # re-created spokes do not keep walking widgets of dead ones
+        self._registry = registry
         self.selected = None
         self._can_be_sensitive = True
         self.dependencies = dependencies or []
+        # (widget, handler_id) pairs from connect(), so the spoke can
+        # block the whole cascade while setting initial state
+        self.handlers = []
+        # reverse edges of the dependency graph, filled by dependents
+        self.dependents = []
+        for dependency in self.dependencies:
+            dependency.dependents.append(self)
+        # caches the sensitive+active GTK query; cleared whenever this
+        # choice's own widget state changes
+        self._selected_cache = None
+        self._pending_reconcile = False
 
         if self.indent:
-            self.outer_widget = Gtk.Alignment()
-            self.outer_widget.add(self.widget)
-            self.outer_widget.set_padding(0, 0, 20, 0)
-        else:
-            self.outer_widget = self.widget
+            # a margin is enough; wrapping in a (deprecated) Gtk.Alignment
+            # costs an extra container per indented row
+            self.widget.set_margin_start(20)
+        self.outer_widget = self.widget
 
     def connect(self, *args):
         raise NotImplementedError
 
+    def _invalidate_selection_cache(self, *args):
+        self._selected_cache = None
+
     def set_selected(self, value):
+        self._invalidate_selection_cache()
         self.widget.set_active(value)
         if self.selected is not None:
             self.selected = value
 
     def set_sensitive(self, sensitive):
         if self._can_be_sensitive:
+            self._invalidate_selection_cache()
             self.widget.set_sensitive(sensitive)
 
     def get_selected(self):
-        return (
-            self.selected
-            if self.selected is not None
-            else self.widget.get_sensitive() and self.widget.get_active()
-        )
+        if self.selected is not None:
+            return self.selected
+        if self._selected_cache is None:
+            self._selected_cache = (
+                self.widget.get_sensitive() and self.widget.get_active()
+            )
+        return self._selected_cache
 
     def are_dependencies_selected(self):
-        dependencies_status = [
+        return all(
             dependency.get_selected() for dependency in self.dependencies
-        ]
-        return all(dependencies_status)
+        )
 
     def friend_on_toggled(self, *args):
+        # a single change can fire both 'toggled' and 'notify::sensitive';
+        # coalesce them into one recompute per main-loop turn
+        if not self._pending_reconcile:
+            self._pending_reconcile = True
+            GLib.idle_add(self._reconcile_sensitivity)
+
+    def _reconcile_sensitivity(self):
+        self._pending_reconcile = False
         self.set_sensitive(self.are_dependencies_selected())
+        return False
 
 
 #
 # Gtk.CheckButton
 #
 class QubesButtonChoice(QubesChoiceBase):
-    def __init__(self, location, label, dependencies=None, indent=False):
+    def __init__(self, location, label, dependencies=None, indent=False, registry=None):
         super().__init__(
             widget=Gtk.CheckButton(label=label),
             location=location,
             indent=indent,
             dependencies=dependencies,
+            registry=registry,
         )
         self.label = label
         self.selected = None
 
+        # direct user toggles must invalidate cached selection state too
+        self.connect(self._invalidate_selection_cache)
+
         for dependency in self.dependencies:
             dependency.connect(self.friend_on_toggled)
             # trigger it now
             self.friend_on_toggled(dependency)
 
-        choices_instances.append(self)
+        if registry is not None:
+            registry.append(self)
 
     def connect(self, *args):
-        self.widget.connect("toggled", *args)
-        self.widget.connect("notify::sensitive", *args)
+        self.handlers.append((self.widget, self.widget.connect("toggled", *args)))
+        self.handlers.append(
+            (self.widget, self.widget.connect("notify::sensitive", *args))
+        )
 
 
 class QubesInstallTemplateChoice(QubesButtonChoice):
-    def __init__(self, location, label, template, dependencies=None, indent=False):
-        super().__init__(location, label, dependencies, indent)
+    def __init__(
+        self, location, label, template, dependencies=None, indent=False, registry=None
+    ):
+        super().__init__(location, label, dependencies, indent, registry)
         self.template = template
 
 
@@ -129,10 +170,17 @@ class QubesInstallTemplateChoice(QubesButtonChoice):
 # Gtk.Box -> Gtk.Label
 #
 class QubesChoiceMessage(QubesChoiceBase):
-    def __init__(self, location=None, indent=False, icon_name=None):
+    # icon-theme lookups decode the icon from disk; share the pixbufs
+    # across (re)constructions, they are refcounted
+    _icon_cache = {}
+
+    def __init__(self, location=None, indent=False, icon_name=None, registry=None):
         self.widget = Gtk.Box()
         if icon_name:
-            icon = Gtk.IconTheme.get_default().load_icon(icon_name, 30, 0)
+            icon = self._icon_cache.get(icon_name)
+            if icon is None:
+                icon = Gtk.IconTheme.get_default().load_icon(icon_name, 30, 0)
+                self._icon_cache[icon_name] = icon
             icon_img = Gtk.Image.new_from_pixbuf(icon)
             self.widget.pack_start(icon_img, False, False, 0)
         self.label_widget = Gtk.Label()
@@ -142,52 +190,120 @@ class QubesChoiceMessage(QubesChoiceBase):
         self.widget.pack_start(self.label_widget, False, True, 10)
         self.widget.show_all()
         self.widget.set_no_show_all(True)
-        super().__init__(widget=self.widget, location=location, indent=indent)
-        choices_instances.append(self)
+        super().__init__(
+            widget=self.widget, location=location, indent=indent, registry=registry
+        )
+        if registry is not None:
+            registry.append(self)
 
 
 #
 # Gtk.CheckButton
 #
 class QubesDisabledButtonChoice(QubesButtonChoice):
-    def __init__(self, location, label, indent=False):
-        super().__init__(location=location, label=label, indent=indent)
+    def __init__(self, location, label, indent=False, registry=None):
+        super().__init__(
+            location=location, label=label, indent=indent, registry=registry
+        )
         self.widget.set_sensitive(False)
         self._can_be_sensitive = False
 
 
+#
+# no widget
+#
+class QubesNoopChoice:
+    """Stands in for choices whose feature is unavailable: reads as never
+    selected and ignores state changes, without touching any widget."""
+
+    class _Widget:
+        @staticmethod
+        def get_sensitive():
+            return False
+
+        @staticmethod
+        def set_active(value):
+            pass
+
+    widget = _Widget()
+
+    def set_selected(self, value):
+        pass
+
+    def get_selected(self):
+        return False
+
+
 #
 # Gtk.CheckButton
 #
 class QubesAdvancedChoice(QubesChoiceBase):
-    def __init__(self, location, label, indent=False):
+    def __init__(self, location, label, indent=False, registry=None):
         super().__init__(
-            widget=Gtk.CheckButton(label=label), location=location, indent=indent
+            widget=Gtk.CheckButton(label=label),
+            location=location,
+            indent=indent,
+            registry=registry,
         )
+        self._last_state = None
         self.widget.connect("toggled", self.disable_configuration)
 
-    @staticmethod
-    def disable_configuration(widget):
+    def disable_configuration(self, widget):
+        # no connect()-installed invalidation handler on this widget
+        self._selected_cache = None
         activated = widget.get_active()
-
-        for choice in choices_instances:
-            choice.set_sensitive(
-                not activated
-                and (choice.dependencies is None or choice.are_dependencies_selected())
-            )
+        if activated == self._last_state:
+            return
+        self._last_state = activated
+
+        # walk the dependency graph from the choices nothing depends on,
+        # enqueueing a dependent only once all its dependencies were
+        # updated, so no choice is recomputed from stale state
+        registry = self._registry or []
+        boxes = {choice.location for choice in registry if choice.location}
+        for box in boxes:
+            box.freeze_notify()
+        try:
+            queue = [choice for choice in registry if not choice.dependencies]
+            seen = set()
+            while queue:
+                choice = queue.pop(0)
+                if id(choice) in seen:
+                    continue
+                seen.add(id(choice))
+                choice.set_sensitive(
+                    not activated and choice.are_dependencies_selected()
+                )
+                for dependent in choice.dependents:
+                    if all(id(d) in seen for d in dependent.dependencies):
+                        queue.append(dependent)
+        finally:
+            for box in boxes:
+                box.thaw_notify()
 
 
 #
 # Gtk.Grid -> Gtk.Label | Gtk.ComboBoxText
 #
 class QubesListChoice(QubesChoiceBase):
-    def __init__(self, location, label, entries=None, dependencies=None):
-        super().__init__(widget=Gtk.Box(), location=location, dependencies=dependencies)
-        self.entries = entries or []
+    def __init__(self, location, label, entries=None, dependencies=None, registry=None):
+        super().__init__(
+            widget=Gtk.Box(),
+            location=location,
+            dependencies=dependencies,
+            registry=registry,
+        )
         self.widget.set_homogeneous(True)
         self.label_widget = Gtk.Label(label=label, halign=1)
         self.combobox_widget = Gtk.ComboBoxText()
 
+        # populate before wiring dependencies: their handlers may already
+        # diff the combobox contents against self.entries
+        self.entries = []
+        self._entry_pos = {}
+        if entries:
+            self._fill_combobox(entries)
+
         for dependency in self.dependencies:
             dependency.connect(self.friend_on_toggled)
             # trigger it now
@@ -197,13 +313,23 @@ class QubesListChoice(QubesChoiceBase):
         self.widget.pack_start(self.label_widget, True, True, 0)
         self.widget.pack_start(self.combobox_widget, True, True, 0)
 
+    def _fill_combobox(self, entries):
+        # detach the model while repopulating, so the combobox processes
+        # one model change instead of one per row
+        model = self.combobox_widget.get_model()
+        self.combobox_widget.set_model(None)
+        model.clear()
         for entry in entries:
-            self.combobox_widget.append_text(entry)
-
-        # choices_instances.append(self)
+            model.insert_with_valuesv(-1, [0], [entry])
+        self.combobox_widget.set_model(model)
+        # keep the entry bookkeeping in sync with the widget
+        self.entries = list(entries)
+        self._entry_pos = {entry: i for i, entry in enumerate(self.entries)}
 
     def connect(self, *args):
-        self.combobox_widget.connect("changed", *args)
+        self.handlers.append(
+            (self.combobox_widget, self.combobox_widget.connect("changed", *args))
+        )
 
     def get_selected(self):
         return self.entries
@@ -212,59 +338,91 @@ class QubesListChoice(QubesChoiceBase):
         return self.combobox_widget.get_active_text()
 
     def set_entry(self, entry):
-        entry_index = self.entries.index(entry)
-        self.combobox_widget.set_active(entry_index)
+        self.combobox_widget.set_active(self._entry_pos[entry])
 
 
 #
 # Gtk.Label | Gtk.ComboBox
 #
 class QubesTemplateChoice(QubesListChoice):
-    def __init__(self, location, entries, dependencies=None):
+    def __init__(self, location, entries, dependencies=None, registry=None):
         super().__init__(
             location=location,
             label="Default:",
             entries=entries,
             dependencies=dependencies,
+            registry=registry,
         )
 
-        choices_instances.append(self)
+        if registry is not None:
+            registry.append(self)
 
     def friend_on_toggled(self, *args):
-        self.combobox_widget.remove_all()
-        self.entries = []
-        for dependency in self.dependencies:
-            if dependency.get_selected():
-                self.entries.append(dependency.label)
-                self.combobox_widget.append_text(dependency.label)
-        self.combobox_widget.set_active(0)
+        new_entries = [
+            dependency.label
+            for dependency in self.dependencies
+            if dependency.get_selected()
+        ]
+        if new_entries != self.entries:
+            previous = self.combobox_widget.get_active_text()
+            # apply only the rows that changed instead of a full rebuild,
+            # and coalesce the resulting notifications
+            self.combobox_widget.freeze_notify()
+            try:
+                current = list(self.entries)
+                for i in range(len(current) - 1, -1, -1):
+                    if current[i] not in new_entries:
+                        self.combobox_widget.remove(i)
+                        del current[i]
+                for i, label in enumerate(new_entries):
+                    if i >= len(current) or current[i] != label:
+                        self.combobox_widget.insert_text(i, label)
+                        current.insert(i, label)
+                self.entries = new_entries
+                self._entry_pos = {
+                    entry: i for i, entry in enumerate(new_entries)
+                }
+                if previous in new_entries:
+                    self.combobox_widget.set_active(new_entries.index(previous))
+                else:
+                    self.combobox_widget.set_active(0)
+            finally:
+                self.combobox_widget.thaw_notify()
         self.combobox_widget.set_sensitive(self.are_dependencies_selected())
 
     def are_dependencies_selected(self):
-        dependencies_status = [
-            dependency.get_selected() for dependency in self.dependencies
-        ]
         # It is 'any' because it's a choice among a list
-        return any(dependencies_status)
+        return any(
+            dependency.get_selected() for dependency in self.dependencies
+        )
 
 
 #
 # Gtk.RadioButton
 #
 class QubesRadioChoice(QubesChoiceBase):
-    def __init__(self, location, label, group=None, dependencies=None, indent=False):
+    def __init__(
+        self, location, label, group=None, dependencies=None, indent=False, registry=None
+    ):
         super().__init__(
             widget=Gtk.RadioButton(label=label, group=group),
             location=location,
             indent=indent,
             dependencies=dependencies,
+            registry=registry,
         )
 
-        choices_instances.append(self)
+        # direct user toggles must invalidate cached selection state too
+        self.connect(self._invalidate_selection_cache)
+
+        if registry is not None:
+            registry.append(self)
 
     def connect(self, *args):
-        self.widget.connect("toggled", *args)
-        self.widget.connect("notify::sensitive", *args)
+        self.handlers.append((self.widget, self.widget.connect("toggled", *args)))
+        self.handlers.append(
+            (self.widget, self.widget.connect("notify::sensitive", *args))
+        )
 
 
 #
@@ -272,13 +430,16 @@ class QubesRadioChoice(QubesChoiceBase):
 # Gtk.Radiobutton
 #
 class QubesInitThinPoolChoice(QubesChoiceBase):
-    def __init__(self, location, thin_pools, indent=False):
+    def __init__(self, location, thin_pools, indent=False, registry=None):
         super().__init__(
-            widget=Gtk.Box(orientation=1), location=location, indent=indent
+            widget=Gtk.Box(orientation=1),
+            location=location,
+            indent=indent,
+            registry=registry,
         )
         self.thin_pools = thin_pools
         self.create_pool_choice = QubesRadioChoice(
-            label=_("Create 'vm-pool' LVM thin pool"), location=None
+            label=_("Create 'vm-pool' LVM thin pool"), location=None, registry=registry
         )
         self.widget.pack_start(self.create_pool_choice.widget, True, True, 0)
 
@@ -286,10 +447,12 @@ class QubesInitThinPoolChoice(QubesChoiceBase):
             label=_("Use existing LVM thin pool"),
             group=self.create_pool_choice.widget,
             location=None,
+            registry=registry,
         )
         self.widget.pack_start(self.custom_pool_choice.widget, True, True, 0)
 
-        choices_instances.append(self)
+        if registry is not None:
+            registry.append(self)
 
 
 #
@@ -297,9 +460,12 @@ class QubesInitThinPoolChoice(QubesChoiceBase):
 # Gtk.Label | Gtk.ComboBox
 #
 class QubesPoolChoice(QubesChoiceBase):
-    def __init__(self, location, pools, dependencies=None):
+    def __init__(self, location, pools, dependencies=None, registry=None):
         super().__init__(
-            widget=Gtk.Box(orientation=1), location=location, dependencies=dependencies
+            widget=Gtk.Box(orientation=1),
+            location=location,
+            dependencies=dependencies,
+            registry=registry,
         )
         self.pools = {}
         for dependency in self.dependencies:
@@ -310,8 +476,14 @@ class QubesPoolChoice(QubesChoiceBase):
         # Merge pools info
         if pools:
             for key, val in pools:
-                self.pools[key] = self.pools.get(key, ()) + (val,)
+                self.pools.setdefault(key, []).append(val)
         self.vgroups = list(self.pools.keys())
+        # position lookups for set_vgroup/set_tpool
+        self._vg_pos = {vg: i for i, vg in enumerate(self.vgroups)}
+        self._tp_pos = {
+            vg: {tp: i for i, tp in enumerate(tpools)}
+            for vg, tpools in self.pools.items()
+        }
 
         self.vg_choice = QubesListChoice(
             label=_("LVM Volume Group:"),
@@ -325,45 +497,52 @@ class QubesPoolChoice(QubesChoiceBase):
         self.widget.pack_start(self.vg_choice.widget, True, True, 0)
         self.widget.pack_start(self.tp_choice.widget, True, True, 0)
 
-        choices_instances.append(self)
+        if registry is not None:
+            registry.append(self)
+
+        # cache the selected texts; each get_active_text() crosses the
+        # PyGObject marshalling boundary
+        self._vgroup_cache = None
+        self._tpool_cache = None
 
         self.connect(self.on_vgroups_combo_changed)
+        self.tp_choice.combobox_widget.connect("changed", self.on_tpools_combo_changed)
 
     def connect(self, *args):
-        self.vg_choice.combobox_widget.connect("changed", *args)
+        widget = self.vg_choice.combobox_widget
+        self.handlers.append((widget, widget.connect("changed", *args)))
 
     def on_vgroups_combo_changed(self, *args):
+        self._vgroup_cache = None
         vgroup = self.get_vgroup()
         self.set_tpools_combo_entries(vgroup)
 
-    def set_tpools_combo_entries(self, vgroup):
-        self.tp_choice.combobox_widget.remove_all()
-        if vgroup in self.pools.keys():
-            for tpool in self.pools[vgroup]:
-                self.tp_choice.combobox_widget.append_text(tpool)
+    def on_tpools_combo_changed(self, *args):
+        self._tpool_cache = None
 
+    def set_tpools_combo_entries(self, vgroup):
+        self.tp_choice._fill_combobox(self.pools.get(vgroup, ()))
         self.tp_choice.combobox_widget.set_active(0)
 
     def get_vgroup(self):
-        return self.vg_choice.combobox_widget.get_active_text()
+        if self._vgroup_cache is None:
+            self._vgroup_cache = self.vg_choice.combobox_widget.get_active_text()
+        return self._vgroup_cache
 
     def get_tpool(self):
-        return self.tp_choice.combobox_widget.get_active_text()
+        if self._tpool_cache is None:
+            self._tpool_cache = self.tp_choice.combobox_widget.get_active_text()
+        return self._tpool_cache
 
     def set_vgroup(self, vgroup):
-        try:
-            vgroup_index = self.vgroups.index(vgroup)
-        except ValueError:
-            # In case of custom install and default value not available
-            vgroup_index = 0
+        # default to the first entry in case of custom install and default
+        # value not available
+        vgroup_index = self._vg_pos.get(vgroup, 0)
         self.vg_choice.combobox_widget.set_active(vgroup_index)
 
     def set_tpool(self, tpool):
         vgroup = self.get_vgroup()
-        try:
-            tpool_index = self.pools[vgroup].index(tpool)
-        except (KeyError, ValueError):
-            tpool_index = 0
+        tpool_index = self._tp_pos.get(vgroup, {}).get(tpool, 0)
         self.tp_choice.combobox_widget.set_active(tpool_index)
 
 
@@ -427,16 +606,25 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
         self.mainBox = self.builder.get_object("mainBox")
         self.advancedBox = self.builder.get_object("advancedBox")
 
-        self.lvm_cache = self.init_cache()
+        self.lvm_cache = None
         self.thin_pools = None
         self.seen = False
-
-        self.init_qubes_choices()
+        self._choices = []
+        # widgets are built from initialize(), which Anaconda may run in a
+        # worker thread while the hub is already responsive
+        self._choices_built = False
 
     def init_qubes_choices(self):
         default_templates = []
         self.template_choices = {}
-        for template, alias in sorted(self.qubes_data.templates_aliases.items()):
+        templates_aliases = self.qubes_data.templates_aliases
+        # keep the snapshot and a reverse lookup, so refresh()/apply() do
+        # not re-fetch and re-scan the dict
+        self._templates_aliases = templates_aliases
+        self._alias_to_template = {
+            alias: template for template, alias in templates_aliases.items()
+        }
+        for template, alias in sorted(templates_aliases.items()):
             if template.startswith("whonix"):
                 continue
             default_templates.append(alias)
@@ -444,24 +632,31 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                 location=self.templatesBox,
                 label=_(alias),
                 template=template,
+                registry=self._choices,
             )
 
         if self.qubes_data.whonix_available:
             self.choice_install_whonix = QubesButtonChoice(
                 location=self.templatesBox,
                 label=_(self.qubes_data.templates_aliases["whonix"]),
+                registry=self._choices,
             )
         else:
             self.choice_install_whonix = QubesDisabledButtonChoice(
-                location=self.templatesBox, label=_("Whonix not available")
+                location=self.templatesBox,
+                label=_("Whonix not available"),
+                registry=self._choices,
             )
-            self.choice_whonix = self.choice_install_whonix
-            self.choice_whonix_updates = self.choice_install_whonix
+            # no-op stand-ins instead of aliasing the disabled button, so
+            # refresh()/apply() do not poke the same widget three times
+            self.choice_whonix = QubesNoopChoice()
+            self.choice_whonix_updates = QubesNoopChoice()
 
         self.choice_default_template = QubesTemplateChoice(
             location=self.templatesBox,
             entries=default_templates,
             dependencies=list(self.template_choices.values()),
+            registry=self._choices,
         )
 
         self.choice_system = QubesButtonChoice(
@@ -470,6 +665,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                 "Create default system qubes (sys-net, sys-firewall, default DispVM)"
             ),
             dependencies=[self.choice_default_template],
+            registry=self._choices,
         )
 
         self.choice_disp_firewallvm_and_usbvm = QubesButtonChoice(
@@ -477,6 +673,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
             label=_("Make sys-firewall and sys-usb disposable"),
             dependencies=[self.choice_system],
             indent=True,
+            registry=self._choices,
         )
 
         self.choice_disp_netvm = QubesButtonChoice(
@@ -484,6 +681,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
             label=_("Make sys-net disposable"),
             dependencies=[self.choice_system],
             indent=True,
+            registry=self._choices,
         )
 
         self.choice_default = QubesButtonChoice(
@@ -492,6 +690,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                 "Create default application qubes (personal, work, untrusted, vault)"
             ),
             dependencies=[self.choice_system],
+            registry=self._choices,
         )
 
         if self.qubes_data.usbvm_available:
@@ -501,11 +700,13 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                     "Use a qube to hold all USB controllers (create a new qube called sys-usb by default)"
                 ),
                 dependencies=[self.choice_default_template],
+                registry=self._choices,
             )
         else:
             self.choice_usb = QubesDisabledButtonChoice(
                 location=self.mainBox,
                 label=_("USB qube configuration disabled - you are using USB disk"),
+                registry=self._choices,
             )
 
         self.choice_usb_with_netvm = QubesButtonChoice(
@@ -513,12 +714,14 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
             label=_("Use sys-net qube for both networking and USB devices"),
             dependencies=[self.choice_usb],
             indent=True,
+            registry=self._choices,
         )
         self.choice_allow_usb_mouse = QubesButtonChoice(
             location=self.mainBox,
             label=_("Automatically accept USB mice (discouraged)"),
             dependencies=[self.choice_usb],
             indent=True,
+            registry=self._choices,
         )
         self.choice_allow_usb_keyboard = QubesButtonChoice(
             location=self.mainBox,
@@ -527,11 +730,13 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
             ),
             dependencies=[self.choice_usb],
             indent=True,
+            registry=self._choices,
         )
         self.usb_keyboards_list = QubesChoiceMessage(
             location=self.mainBox,
             indent=True,
             icon_name="help-about",
+            registry=self._choices,
         )
 
         if self.qubes_data.whonix_available:
@@ -544,6 +749,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                     self.choice_install_whonix,
                     self.choice_system,
                 ],
+                registry=self._choices,
             )
 
             self.choice_whonix_updates = QubesButtonChoice(
@@ -557,6 +763,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
                     self.choice_whonix,
                 ],
                 indent=True,
+                registry=self._choices,
             )
 
         if self.qubes_data.lvm_setup:
@@ -565,60 +772,127 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
             self.choice_select_pool = QubesInitThinPoolChoice(
                 location=self.advancedBox,
                 thin_pools=self.thin_pools,
+                registry=self._choices,
             )
 
-            choice_pool_list_kwargs = {
+            # the VG/thin-pool combos only matter once the user picks "use
+            # existing pool"; defer building them until that happens
+            self.choice_pool_list = None
+            self._pool_list_kwargs = {
                 "location": self.advancedBox,
                 "pools": self.thin_pools,
                 "dependencies": [],
+                "registry": self._choices,
             }
             if self.thin_pools:
-                choice_pool_list_kwargs["dependencies"].append(
+                self._pool_list_kwargs["dependencies"].append(
                     self.choice_select_pool.custom_pool_choice
                 )
-            self.choice_pool_list = QubesPoolChoice(**choice_pool_list_kwargs)
+                self.choice_select_pool.custom_pool_choice.widget.connect(
+                    "toggled", self._ensure_pool_list
+                )
 
         self.check_advanced = QubesAdvancedChoice(
             location=self.advancedBox,
             label=_("Do not configure anything (for advanced users)"),
+            registry=self._choices,
         )
 
-        for choice in choices_instances:
-            if not choice.location:
-                continue
-            choice.location.pack_start(choice.outer_widget, False, True, 0)
-
-        # self.templatesBox.reorder_child(
-        #     self.builder.get_object("templateDefaultBox"), -1
-        # )
-
-        self.advancedBox.pack_start(self.check_advanced.widget, False, True, 0)
-
-        # Default choices
-        for choice in self.template_choices.values():
-            choice.widget.set_active(True)
-        if self.choice_install_whonix.widget.get_sensitive():
-            self.choice_install_whonix.widget.set_active(True)
-
-        self.choice_system.widget.set_active(True)
-
-        self.choice_disp_firewallvm_and_usbvm.widget.set_active(True)
-
-        self.choice_default.widget.set_active(True)
+        # batch the packing to avoid a child-notify/relayout pass per widget
+        boxes = [self.templatesBox, self.mainBox, self.advancedBox]
+        for box in boxes:
+            box.freeze_child_notify()
+        try:
+            for choice in (c for c in self._choices if c.location):
+                choice.location.pack_start(choice.outer_widget, False, True, 0)
+
+            # self.templatesBox.reorder_child(
+            #     self.builder.get_object("templateDefaultBox"), -1
+            # )
+
+            self.advancedBox.pack_start(self.check_advanced.widget, False, True, 0)
+        finally:
+            for box in boxes:
+                box.thaw_child_notify()
+
+        # Default choices - block the handlers registered via connect()
+        # while setting initial state, so every set_active does not re-run
+        # the whole dependency cascade, then reconcile once at the end
+        all_handlers = [
+            handler for choice in self._choices for handler in choice.handlers
+        ]
+        for widget, handler_id in all_handlers:
+            widget.handler_block(handler_id)
+        try:
+            for choice in self.template_choices.values():
+                choice.widget.set_active(True)
+            if self.choice_install_whonix.widget.get_sensitive():
+                self.choice_install_whonix.widget.set_active(True)
+
+            self.choice_system.widget.set_active(True)
+
+            self.choice_disp_firewallvm_and_usbvm.widget.set_active(True)
+
+            self.choice_default.widget.set_active(True)
+
+            if self.choice_whonix.widget.get_sensitive():
+                self.choice_whonix.widget.set_active(True)
+
+            if self.choice_usb.widget.get_sensitive():
+                self.choice_usb.widget.set_active(True)
+        finally:
+            for widget, handler_id in all_handlers:
+                widget.handler_unblock(handler_id)
+
+        # the blocked handlers included the _invalidate_selection_cache
+        # hooks, so every selection cache still holds pre-default state;
+        # clear them before anything reads get_selected() again
+        for choice in self._choices:
+            choice._invalidate_selection_cache()
+
+        # the blocked handlers also skipped the default-template combo
+        # rebuild; do it once, then recompute all sensitivities in one pass
+        self.choice_default_template.friend_on_toggled()
+        self.check_advanced.disable_configuration(self.check_advanced.widget)
+
+        self._apply_flat_style()
+
+    def _apply_flat_style(self):
+        # Initial Setup renders without GPU acceleration; flat styling keeps
+        # the repaints caused by sensitivity cascades cheap. Scoped to this
+        # spoke's widgets to not affect other spokes.
+        provider = Gtk.CssProvider()
+        provider.load_from_data(
+            b"* { border-radius: 0; box-shadow: none; transition: none; }"
+        )
+        widgets = [self.templatesBox, self.mainBox, self.advancedBox]
+        widgets.extend(choice.widget for choice in self._choices)
+        for widget in widgets:
+            widget.get_style_context().add_provider(
+                provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION
+            )
 
-        if self.choice_whonix.widget.get_sensitive():
-            self.choice_whonix.widget.set_active(True)
+    def _ensure_pool_list(self, *args):
+        """Build the VG/thin-pool selection widgets on first use."""
+        if self.choice_pool_list is not None:
+            return self.choice_pool_list
+
+        self.choice_pool_list = QubesPoolChoice(**self._pool_list_kwargs)
+        outer = self.choice_pool_list.outer_widget
+        self.advancedBox.pack_start(outer, False, True, 0)
+        # keep it above the "do not configure anything" checkbox
+        self.advancedBox.reorder_child(
+            outer, len(self.advancedBox.get_children()) - 2
+        )
+        outer.show_all()
 
-        if self.choice_usb.widget.get_sensitive():
-            self.choice_usb.widget.set_active(True)
+        # If available, we set Qubes default value
+        # for VG and THIN POOL
+        if ("qubes_dom0", "vm-pool") in self.thin_pools:
+            self.choice_pool_list.set_vgroup("qubes_dom0")
+            self.choice_pool_list.set_tpool("vm-pool")
 
-        if self.qubes_data.lvm_setup and self.thin_pools:
-            # If available, we set Qubes default value
-            # for VG and THIN POOL
-            if ("qubes_dom0", "vm-pool") in self.thin_pools:
-                self.choice_pool_list.set_vgroup("qubes_dom0")
-                self.choice_pool_list.set_tpool("vm-pool")
-            self.choice_pool_list.widget.set_sensitive(False)
+        return self.choice_pool_list
 
     def initialize(self):
         """
@@ -632,6 +906,20 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
 
         NormalSpoke.initialize(self)
 
+        # run the blocking lvs probe here rather than in __init__; widget
+        # construction is marshalled back onto the main loop, and the hub
+        # is told to re-check ready once it happened
+        hubQ.send_not_ready(self.__class__.__name__)
+        self.lvm_cache = self.init_cache()
+        GLib.idle_add(self._materialize_choices)
+
+    def _materialize_choices(self):
+        if not self._choices_built:
+            self.init_qubes_choices()
+            self._choices_built = True
+            hubQ.send_ready(self.__class__.__name__)
+        return False
+
     def refresh(self):
         """
         The refresh method that is called every time the spoke is displayed.
@@ -642,63 +930,68 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
 
         """
 
+        # in case the idle callback scheduled by initialize() did not get
+        # to run yet; refresh() is always on the main thread
+        self._materialize_choices()
+
+        # snapshot every DBus-backed property once per refresh instead of
+        # re-fetching it through the proxy at each use
+        qubes_data = self.qubes_data
+
+        templates_to_install = frozenset(qubes_data.templates_to_install)
         for template_choice in self.template_choices.values():
             template_choice.set_selected(
-                template_choice.template in self.qubes_data.templates_to_install
+                template_choice.template in templates_to_install
             )
 
         self.choice_install_whonix.set_selected(
-            self.qubes_data.whonix_available
-            and "whonix-gateway" in self.qubes_data.templates_to_install
-            and "whonix-workstation" in self.qubes_data.templates_to_install
+            qubes_data.whonix_available
+            and "whonix-gateway" in templates_to_install
+            and "whonix-workstation" in templates_to_install
         )
 
-        for key, val in self.qubes_data.templates_aliases.items():
-            if key == self.qubes_data.default_template:
-                self.choice_default_template.set_entry(val)
-                break
+        default_alias = self._templates_aliases.get(qubes_data.default_template)
+        if default_alias is not None:
+            self.choice_default_template.set_entry(default_alias)
 
-        self.choice_system.set_selected(self.qubes_data.system_vms)
+        self.choice_system.set_selected(qubes_data.system_vms)
 
         self.choice_disp_firewallvm_and_usbvm.set_selected(
-            self.qubes_data.disp_firewallvm_and_usbvm
+            qubes_data.disp_firewallvm_and_usbvm
         )
-        self.choice_disp_netvm.set_selected(self.qubes_data.disp_netvm)
+        self.choice_disp_netvm.set_selected(qubes_data.disp_netvm)
 
-        self.choice_default.set_selected(self.qubes_data.default_vms)
+        self.choice_default.set_selected(qubes_data.default_vms)
 
-        self.choice_whonix.set_selected(self.qubes_data.whonix_vms)
-        self.choice_whonix_updates.set_selected(self.qubes_data.whonix_default)
+        self.choice_whonix.set_selected(qubes_data.whonix_vms)
+        self.choice_whonix_updates.set_selected(qubes_data.whonix_default)
 
-        self.choice_usb.set_selected(self.qubes_data.usbvm)
-        self.choice_usb_with_netvm.set_selected(self.qubes_data.usbvm_with_netvm)
-        self.choice_allow_usb_mouse.set_selected(self.qubes_data.allow_usb_mouse)
-        self.choice_allow_usb_keyboard.set_selected(self.qubes_data.allow_usb_keyboard)
-        if self.qubes_data.usb_keyboards_detected:
+        self.choice_usb.set_selected(qubes_data.usbvm)
+        self.choice_usb_with_netvm.set_selected(qubes_data.usbvm_with_netvm)
+        self.choice_allow_usb_mouse.set_selected(qubes_data.allow_usb_mouse)
+        self.choice_allow_usb_keyboard.set_selected(qubes_data.allow_usb_keyboard)
+        usb_keyboards_detected = qubes_data.usb_keyboards_detected
+        if usb_keyboards_detected:
             self.usb_keyboards_list.label_widget.set_markup(
                 _(
                     "<b>INFO:</b> the following USB keyboards will be connected to sys-usb:\n{}\n"
                     "<b>If you disable the option above, they will not function in Qubes.</b>"
-                ).format(
-                    "\n".join(
-                        "- {}".format(k) for k in self.qubes_data.usb_keyboards_detected
-                    )
-                )
+                ).format("\n".join(f"- {k}" for k in usb_keyboards_detected))
             )
-        self.usb_keyboards_list.widget.set_visible(
-            bool(self.qubes_data.usb_keyboards_detected)
-        )
+        self.usb_keyboards_list.widget.set_visible(bool(usb_keyboards_detected))
 
-        if self.qubes_data.lvm_setup:
+        if qubes_data.lvm_setup:
             self.choice_select_pool.create_pool_choice.set_selected(
-                self.qubes_data.create_default_tpool
+                qubes_data.create_default_tpool
             )
-            if self.qubes_data.vg_tpool and self.qubes_data.vg_tpool in self.thin_pools:
-                vg, tpool = self.qubes_data.vg_tpool
-                self.choice_pool_list.set_vgroup(vg)
-                self.choice_pool_list.set_tpool(tpool)
+            vg_tpool = qubes_data.vg_tpool
+            if vg_tpool and vg_tpool in self.thin_pools:
+                vg, tpool = vg_tpool
+                pool_list = self._ensure_pool_list()
+                pool_list.set_vgroup(vg)
+                pool_list.set_tpool(tpool)
 
-        self.check_advanced.set_selected(self.qubes_data.skip)
+        self.check_advanced.set_selected(qubes_data.skip)
 
     def apply(self):
         """
@@ -709,18 +1002,20 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
 
         self.qubes_data.skip = self.check_advanced.get_selected()
 
-        templates_to_install = []
-        for template_choice in self.template_choices.values():
-            if template_choice.get_selected():
-                templates_to_install.append(template_choice.template)
+        templates_to_install = [
+            template_choice.template
+            for template_choice in self.template_choices.values()
+            if template_choice.get_selected()
+        ]
         if self.choice_install_whonix.get_selected():
-            templates_to_install += ["whonix-gateway", "whonix-workstation"]
+            templates_to_install.extend(("whonix-gateway", "whonix-workstation"))
 
         self.qubes_data.templates_to_install = templates_to_install
-        for key, val in self.qubes_data.templates_aliases.items():
-            if self.choice_default_template.get_entry() == val:
-                self.qubes_data.default_template = key
-                break
+        default_template = self._alias_to_template.get(
+            self.choice_default_template.get_entry()
+        )
+        if default_template is not None:
+            self.qubes_data.default_template = default_template
 
         self.qubes_data.system_vms = self.choice_system.get_selected()
 
@@ -741,16 +1036,12 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
         if self.qubes_data.lvm_setup:
             if self.choice_select_pool.create_pool_choice.get_selected():
                 self.qubes_data.create_default_tpool = True
-            elif (
-                self.choice_pool_list
-                and self.choice_pool_list.get_vgroup()
-                and self.choice_pool_list.get_tpool()
-            ):
-                self.qubes_data.vg_tpool = (
-                    self.choice_pool_list.get_vgroup(),
-                    self.choice_pool_list.get_tpool(),
-                )
-                self.qubes_data.create_default_tpool = False
+            elif self.choice_pool_list:
+                vgroup = self.choice_pool_list.get_vgroup()
+                tpool = self.choice_pool_list.get_tpool()
+                if vgroup and tpool:
+                    self.qubes_data.vg_tpool = (vgroup, tpool)
+                    self.qubes_data.create_default_tpool = False
 
         self.seen = True
 
@@ -764,7 +1055,7 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
 
         """
 
-        return True
+        return self._choices_built
 
     @property
     def completed(self):
@@ -816,50 +1107,85 @@ class QubesOsSpoke(FirstbootOnlySpokeMixIn, NormalSpoke):
 
     @staticmethod
     def _parse_lvm_cache(lvm_output):
-        result = {}
+        # only thin pools are ever consumed, so filter while parsing and
+        # keep just the (vg_name, lv_name) pairs
+        thin_pools = []
+
+        report = json.loads(lvm_output)
+        for entry in report.get("report", []):
+            for lv in entry.get("lv", []):
+                vg_name = lv["vg_name"]
+                lv_name = lv["lv_name"]
+                if "" in [vg_name, lv_name]:
+                    continue
+                attr = lv["lv_attr"]
+                if not attr or attr[0] != "t":
+                    continue
+                thin_pools.append((vg_name, lv_name))
+
+        return thin_pools
 
-        for line in lvm_output.splitlines():
-            line = line.decode().strip()
-            vg_name, name, attr = line.split(";", 3)
-            if "" in [vg_name, name]:
-                continue
-            name = vg_name + "/" + name
-            result[name] = {"attr": attr}
+    @staticmethod
+    def _lvm_metadata_mtime():
+        # LVM refreshes metadata backups whenever the layout changes
+        try:
+            return os.stat("/etc/lvm/backup").st_mtime
+        except OSError:
+            return None
+
+    def _load_lvm_cache(self):
+        try:
+            cache_mtime = os.stat(LVM_CACHE_PATH).st_mtime
+        except OSError:
+            return None
+        metadata_mtime = self._lvm_metadata_mtime()
+        if metadata_mtime is None or metadata_mtime > cache_mtime:
+            # storage layout changed since the cache was written, or we
+            # have no way to tell - re-run lvs to be safe
+            return None
+        try:
+            with open(LVM_CACHE_PATH) as cache_file:
+                # JSON stores the pairs as lists
+                return [tuple(pool) for pool in json.load(cache_file)]
+        except (OSError, ValueError):
+            return None
 
-        return result
+    def _save_lvm_cache(self, cache):
+        try:
+            os.makedirs(os.path.dirname(LVM_CACHE_PATH), exist_ok=True)
+            with open(LVM_CACHE_PATH + ".tmp", "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(LVM_CACHE_PATH + ".tmp", LVM_CACHE_PATH)
+        except OSError as e:
+            self.logger.warning("Failed to write LVM cache: %s", e)
 
     def init_cache(self):
-        cmd = ["lvs", "--noheadings", "-o", "vg_name,name,lv_attr", "--separator", ";"]
-        if os.getuid() != 0:
-            cmd = ["sudo"] + cmd
-        environ = os.environ.copy()
-        environ["LC_ALL"] = "C.utf8"
-        p = subprocess.Popen(
+        # dom0 storage rarely changes between Initial Setup launches, and
+        # Anaconda may reinstantiate the spoke - avoid re-running 'lvs' if a
+        # fresh cache from a previous run is available
+        cache = self._load_lvm_cache()
+        if cache is not None:
+            return cache
+
+        # Initial Setup always runs as root, no sudo needed
+        cmd = ["lvs", "-o", "vg_name,lv_name,lv_attr", "--reportformat", "json"]
+        environ = {**os.environ, "LC_ALL": "C.utf8"}
+        res = subprocess.run(
             cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            close_fds=True,
+            capture_output=True,
+            text=True,
             env=environ,
+            check=False,
         )
-        out, err = p.communicate()
-        return_code = p.returncode
-        if return_code == 0 and err:
-            self.logger.warning(err)
-        elif return_code != 0:
-            raise ValueError(err)
+        if res.returncode != 0:
+            raise ValueError(res.stderr)
+        if res.stderr:
+            self.logger.warning(res.stderr)
 
-        return self._parse_lvm_cache(out)
+        cache = self._parse_lvm_cache(res.stdout)
+        self._save_lvm_cache(cache)
+        return cache
 
     def get_thin_pools(self):
         """Return list of thin pools"""
-        thpools = []
-        if self.lvm_cache:
-            for key, vol in self.lvm_cache.items():
-                if vol["attr"] and vol["attr"][0] == "t":
-                    # e.g. 'qubes_dom0/pool00'
-                    parsed_key = key.split("/")
-                    if len(parsed_key) == 2:
-                        volume_group = parsed_key[0]
-                        thin_pool = parsed_key[1]
-                        thpools.append((volume_group, thin_pool))
-        return thpools
+        return list(self.lvm_cache or [])
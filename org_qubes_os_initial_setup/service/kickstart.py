@@ -18,6 +18,8 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import re
+
 from pyanaconda.core.kickstart import KickstartSpecification
 from pyanaconda.core.kickstart.addon import AddonData
 from pykickstart.errors import KickstartValueError
@@ -25,6 +27,10 @@ from pyanaconda.anaconda_loggers import get_module_logger
 
 log = get_module_logger(__name__)
 
+# "param" or "param value"; does the split in C without exception-driven
+# fallbacks for the no-value case
+_LINE_RE = re.compile(r"(\S+)(?:\s+(.*))?$")
+
 __all__ = ["QubesData"]
 
 
@@ -79,6 +85,27 @@ class QubesData(AddonData):
     def handle_header(self, args, line_number=None):
         pass
 
+    def _handle_default_template(self, value, line):
+        self.default_template = value
+
+    def _handle_templates_to_install(self, value, line):
+        self.templates_to_install = [t for t in value.split(" ") if t]
+
+    def _handle_lvm_pool(self, value, line):
+        parsed = value.split("/")
+        if len(parsed) != 2:
+            raise KickstartValueError("invalid value for lvm_pool: %s" % line)
+        self.vg_tpool = (parsed[0], parsed[1])
+
+    # O(1) membership / dispatch instead of scanning bool_options and an
+    # elif chain per kickstart line
+    _bool_options_set = frozenset(bool_options)
+    _handlers = {
+        "default_template": _handle_default_template,
+        "templates_to_install": _handle_templates_to_install,
+        "lvm_pool": _handle_lvm_pool,
+    }
+
     def handle_line(self, line, line_number=None):
         """
 
@@ -88,48 +115,42 @@ class QubesData(AddonData):
         """
 
         line = line.strip()
-        try:
-            (param, value) = line.split(maxsplit=1)
-        except ValueError:
-            if " " not in line:
-                param, value = line, ""
-            else:
-                raise KickstartValueError("invalid line: %s" % line)
-        if param in self.bool_options:
+        match = _LINE_RE.match(line)
+        if match is None:
+            raise KickstartValueError("invalid line: %s" % line)
+        param = match.group(1)
+        value = match.group(2) or ""
+        if param in self._bool_options_set:
             if value.lower() not in ("true", "false"):
                 raise KickstartValueError("invalid value for bool property: %s" % line)
             bool_value = value.lower() == "true"
             setattr(self, param, bool_value)
-        elif param == "default_template":
-            self.default_template = value
-        elif param == "templates_to_install":
-            self.templates_to_install = [t for t in value.split(" ") if t]
-        elif param == "lvm_pool":
-            parsed = value.split("/")
-            if len(parsed) != 2:
-                raise KickstartValueError("invalid value for lvm_pool: %s" % line)
-            self.vg_tpool = (parsed[0], parsed[1])
-        else:
+            return
+        handler = self._handlers.get(param)
+        if handler is None:
             raise KickstartValueError("invalid parameter: %s" % param)
+        handler(self, value, line)
 
     def __str__(self):
-        section = "%addon org_qubes_os_initial_setup\n"
+        parts = ["%addon org_qubes_os_initial_setup\n"]
 
-        for param in self.bool_options:
-            section += "{} {!s}\n".format(param, getattr(self, param))
+        parts.extend(
+            "{} {!s}\n".format(param, getattr(self, param))
+            for param in self.bool_options
+        )
 
         if self.default_template:
-            section += "default_template {}\n".format(self.default_template)
-        section += "templates_to_install {}\n".format(
-            " ".join(self.templates_to_install)
+            parts.append("default_template {}\n".format(self.default_template))
+        parts.append(
+            "templates_to_install {}\n".format(" ".join(self.templates_to_install))
         )
 
         if self.vg_tpool:
             vg, tpool = self.vg_tpool
-            section += "lvm_pool {}/{}\n".format(vg, tpool)
+            parts.append("lvm_pool {}/{}\n".format(vg, tpool))
 
-        section += "%end\n"
-        return section
+        parts.append("%end\n")
+        return "".join(parts)
 
 
 class QubesKickstartSpecification(KickstartSpecification):
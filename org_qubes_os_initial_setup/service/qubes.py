@@ -16,6 +16,7 @@
 #
 # You should have received a copy of the GNU General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import functools
 import logging
 
 from dasbus.signal import Signal
@@ -34,7 +35,7 @@ from org_qubes_os_initial_setup.service.qubes_interface import (
 from org_qubes_os_initial_setup.service.tasks import (
     DefaultKernelTask,
     DefaultPoolTask,
-    InstallTemplateTask,
+    InstallTemplatesTask,
     CleanTemplatePkgsTask,
     ConfigureDom0Task,
     SetDefaultTemplateTask,
@@ -54,6 +55,11 @@ from org_qubes_os_initial_setup.utils import (
 
 log = logging.getLogger(__name__)
 
+# distinguishes "property never set" from any real value in __setattr__
+_UNSET = object()
+
+_DIGITS = frozenset("0123456789")
+
 
 class QubesInitialSetup(KickstartService):
     properties = (
@@ -74,6 +80,8 @@ class QubesInitialSetup(KickstartService):
         "lvm_setup",
         "create_default_tpool",
     )
+    # frozenset twin for the attribute-access hot path
+    _properties_set = frozenset(properties)
 
     def __init__(self):
         super().__init__()
@@ -92,9 +100,6 @@ class QubesInitialSetup(KickstartService):
             version = get_template_version("whonix-workstation")
             self.templates_aliases["whonix"] = "Whonix %s" % version
 
-        self.usbvm_available = not started_from_usb()
-        self.usb_keyboards_detected = usb_keyboard_present()
-
         self._system_vms = True
 
         self._disp_firewallvm_and_usbvm = True
@@ -105,23 +110,12 @@ class QubesInitialSetup(KickstartService):
         self._whonix_vms = self.whonix_available
         self._whonix_default = False
 
-        self.usb_keyboards_detected = usb_keyboard_present()
-        self._usbvm = self.usbvm_available
         self._usbvm_with_netvm = False
         self._allow_usb_mouse = False
-        self._allow_usb_keyboard = bool(self.usb_keyboards_detected)
 
-        self._lvm_setup = True
-        self._create_default_tpool = True
-
-        default_tpool = get_default_tpool()
-        if default_tpool:
-            vg, tpool, create = default_tpool
-            self._vg_tpool = vg, tpool
-            self._create_default_tpool = create
-        else:
-            self._vg_tpool = ("", "")
-            self._lvm_setup = False
+        # _usbvm, _allow_usb_keyboard and the storage defaults are left
+        # unset here: their defaults need udev/lvs probes, which run on
+        # first read (see __getattr__) unless kickstart set them earlier
 
         self._skip = False
 
@@ -140,15 +134,70 @@ class QubesInitialSetup(KickstartService):
         for attr in self.properties:
             setattr(self, attr + "_changed", Signal())
 
+    @functools.cached_property
+    def usbvm_available(self):
+        return not started_from_usb()
+
+    @functools.cached_property
+    def usb_keyboards_detected(self):
+        return usb_keyboard_present()
+
+    def _init_usbvm_default(self):
+        self._usbvm = self.usbvm_available
+
+    def _init_usb_keyboard_default(self):
+        self._allow_usb_keyboard = bool(self.usb_keyboards_detected)
+
+    def _init_storage_defaults(self):
+        defaults = {
+            "_lvm_setup": True,
+            "_create_default_tpool": True,
+            "_vg_tpool": ("", ""),
+        }
+        default_tpool = get_default_tpool()
+        if default_tpool:
+            vg, tpool, create = default_tpool
+            defaults["_vg_tpool"] = (vg, tpool)
+            defaults["_create_default_tpool"] = create
+        else:
+            defaults["_lvm_setup"] = False
+
+        # do not overwrite values that kickstart already provided
+        for attr, value in defaults.items():
+            if attr not in self.__dict__:
+                self.__dict__[attr] = value
+
+    # properties whose default needs an expensive probe; each resolver
+    # fills in the missing private attribute(s) on first read
+    _lazy_defaults = {
+        "usbvm": _init_usbvm_default,
+        "allow_usb_keyboard": _init_usb_keyboard_default,
+        "lvm_setup": _init_storage_defaults,
+        "create_default_tpool": _init_storage_defaults,
+        "vg_tpool": _init_storage_defaults,
+    }
+
     def __getattr__(self, item):
-        if item in self.properties:
-            return getattr(self, "_" + item)
+        if item in self._properties_set:
+            private = "_" + item
+            if private not in self.__dict__:
+                lazy_init = self._lazy_defaults.get(item)
+                if lazy_init is not None:
+                    lazy_init(self)
+            try:
+                return self.__dict__[private]
+            except KeyError:
+                raise AttributeError(item) from None
         return super().__getattr__(item)
 
     def __setattr__(self, key, value):
-        if key in self.properties:
-            setattr(self, "_" + key, value)
-            getattr(self, key + "_changed").emit()
+        if key in self._properties_set:
+            old = self.__dict__.get("_" + key, _UNSET)
+            self.__dict__["_" + key] = value
+            # skip the PropertiesChanged round-trip for no-op assignments
+            # (process_kickstart re-assigns every property)
+            if old is _UNSET or old != value:
+                getattr(self, key + "_changed").emit()
             return
         super().__setattr__(key, value)
 
@@ -206,9 +255,8 @@ class QubesInitialSetup(KickstartService):
 
         start_usb = self.usbvm and not self.usbvm_with_netvm
         # resolve template version, if kickstart doesn't include it already
-        if self.default_template and not any(
-            x.isdigit() for x in self.default_template
-        ):
+        # (isdisjoint runs the per-character scan in C)
+        if self.default_template and _DIGITS.isdisjoint(self.default_template):
             default_template = get_template_name(self.default_template)
             if default_template is None:
                 log.warning("Template '%s' not found", self.default_template)
@@ -224,8 +272,16 @@ class QubesInitialSetup(KickstartService):
                     vg_tpool=self.vg_tpool,
                 )
             )
+        # skip templates without an RPM up front instead of letting the
+        # install task discover them
+        templates_to_install = []
         for template in self.templates_to_install:
-            tasks.append(InstallTemplateTask(template=template))
+            if is_template_rpm_available(template):
+                templates_to_install.append(template)
+            else:
+                log.warning("Template '%s' not available, skipping", template)
+        if templates_to_install:
+            tasks.append(InstallTemplatesTask(templates=templates_to_install))
         tasks.append(CleanTemplatePkgsTask())
         tasks.append(ConfigureDom0Task())
         if default_template:
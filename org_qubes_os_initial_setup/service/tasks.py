@@ -16,11 +16,12 @@
 #
 # You should have received a copy of the GNU General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import glob
 import logging
 import os
-import shutil
+import re
 import subprocess
-from looseversion import LooseVersion
+import tempfile
 
 from pyanaconda.core import util
 from pyanaconda.core.configuration.anaconda import conf
@@ -32,23 +33,43 @@ from org_qubes_os_initial_setup.utils import get_template_name, get_template_rpm
 log = logging.getLogger(__name__)
 
 
+def _kernel_version_key(version):
+    # kernel directory names are dotted, mostly numeric strings like
+    # 6.6.21-1; compare numeric parts as integers, anything else low
+    return tuple(
+        int(part) if part.isdigit() else -1 for part in re.split(r"[.-]", version)
+    )
+
+
 class BaseQubesTask(Task):
-    def run_command(self, command, stdin=None, ignore_failure=False):
+    # the target root cannot change while the tasks run; resolve it once
+    _sys_root = None
+
+    def run_command(self, command, stdin=None, ignore_failure=False,
+                    capture_stdout=True):
         process_error = None
         # not really needed, but make static analysis happy
         stdout = None
         stderr = None
 
         try:
-            sys_root = conf.target.system_root
+            sys_root = BaseQubesTask._sys_root
+            if sys_root is None:
+                sys_root = BaseQubesTask._sys_root = conf.target.system_root
 
             cmd = util.startProgram(
-                command, stderr=subprocess.PIPE, stdin=stdin, root=sys_root
+                command,
+                stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                stdin=stdin,
+                root=sys_root,
             )
 
             (stdout, stderr) = cmd.communicate()
 
-            stdout = stdout.decode("utf-8")
+            # callers that discard the output (salt can print tens of MB)
+            # skip the buffering and decode pass
+            stdout = stdout.decode("utf-8") if capture_stdout else ""
             stderr = stderr.decode("utf-8")
 
             if not ignore_failure and cmd.returncode != 0:
@@ -72,11 +93,11 @@ class DefaultKernelTask(BaseQubesTask):
         return "Setup up default kernel"
 
     def run(self):
-        installed_kernels = os.listdir("/var/lib/qubes/vm-kernels")
-        installed_kernels = [
-            LooseVersion(x) for x in installed_kernels if x[0].isdigit()
-        ]
-        default_kernel = str(sorted(installed_kernels)[-1])
+        with os.scandir("/var/lib/qubes/vm-kernels") as entries:
+            installed_kernels = [
+                entry.name for entry in entries if entry.name[0].isdigit()
+            ]
+        default_kernel = max(installed_kernels, key=_kernel_version_key)
         self.run_command(["/usr/bin/qubes-prefs", "default-kernel", default_kernel])
 
 
@@ -115,16 +136,16 @@ class DefaultPoolTask(BaseQubesTask):
         if self.vg_tpool:
             volume_group, thin_pool = self.vg_tpool
 
-            sys_root = conf.target.system_root
-
-            cmd = util.startProgram(
-                ["qvm-pool", "info", thin_pool],
-                stderr=subprocess.DEVNULL,
-                stdin=subprocess.DEVNULL,
-                root=sys_root,
-            )
-            cmd.wait()
-            if cmd.returncode != 0:
+            # one pool listing instead of a dedicated qvm-pool info probe;
+            # keep every line - a possible header row is harmless in a
+            # membership test, while skipping a real pool is not
+            stdout, _stderr = self.run_command(["/usr/bin/qvm-pool", "list"])
+            existing_pools = {
+                line.split(None, 1)[0]
+                for line in stdout.splitlines()
+                if line.strip()
+            }
+            if thin_pool not in existing_pools:
                 # create only if it doesn't exist already
                 self.run_command(
                     [
@@ -141,21 +162,36 @@ class DefaultPoolTask(BaseQubesTask):
             self.run_command(["/usr/bin/qubes-prefs", "default-pool", thin_pool])
 
 
-class InstallTemplateTask(BaseQubesTask):
-    def __init__(self, template):
+class InstallTemplatesTask(BaseQubesTask):
+    def __init__(self, templates):
         super().__init__()
-        self.template = template
+        self.templates = templates
 
     @property
     def name(self):
-        return "Install template " + self.template
+        return "Install templates " + ", ".join(self.templates)
 
     def run(self):
-        template = self.template
-        template_name = get_template_name(template)
-        self.report_progress("Installing TemplateVM %s" % template_name)
-        rpm = get_template_rpm(template)
-        self.run_command(["/usr/bin/qvm-template", "install", "--nogpgcheck", rpm])
+        rpms = []
+        template_names = []
+        for template in self.templates:
+            rpm = get_template_rpm(template)
+            if rpm is None:
+                log.warning("Template '%s' not available, skipping", template)
+                continue
+            rpms.append(rpm)
+            template_names.append(get_template_name(template))
+        if not rpms:
+            return
+        self.report_progress(
+            "Installing TemplateVMs %s" % ", ".join(template_names)
+        )
+        # a single qvm-template run installs them all; parallel invocations
+        # would only serialize on qvm-template's global lock while paying
+        # one interpreter start-up each
+        self.run_command(
+            ["/usr/bin/qvm-template", "install", "--nogpgcheck"] + rpms
+        )
 
 
 class CleanTemplatePkgsTask(BaseQubesTask):
@@ -164,9 +200,27 @@ class CleanTemplatePkgsTask(BaseQubesTask):
         return "Setting up default pool"
 
     def run(self):
-        # Clean RPM after install of selected ones
-        if os.path.exists(TEMPLATES_RPM_PATH):
-            shutil.rmtree(TEMPLATES_RPM_PATH)
+        # Clean RPM after install of selected ones: rename the directory
+        # away (atomic), then let a detached rm -rf unlink the
+        # multi-gigabyte payload while the remaining tasks run. The rename
+        # target is unique per run, so a retry after an interrupted
+        # deletion cannot collide with its leftovers; those are swept into
+        # the same rm call instead.
+        base = TEMPLATES_RPM_PATH.rstrip("/")
+        parent, basename = os.path.split(base)
+        try:
+            doomed = tempfile.mkdtemp(prefix=basename + ".gone.", dir=parent)
+            os.rename(base, os.path.join(doomed, basename))
+        except FileNotFoundError:
+            pass
+        doomed_dirs = glob.glob(os.path.join(parent, basename + ".gone.*"))
+        if doomed_dirs:
+            subprocess.Popen(
+                ["/usr/bin/rm", "-rf", "--"] + doomed_dirs,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
 
 
 class ConfigureDom0Task(BaseQubesTask):
@@ -175,14 +229,17 @@ class ConfigureDom0Task(BaseQubesTask):
         return "Setup up administration VM (dom0)"
 
     def run(self):
-        for service in ["rdisc", "kdump", "libvirt-guests", "salt-minion"]:
-            self.run_command(
-                ["systemctl", "disable", "{}.service".format(service)],
-                ignore_failure=True,
-            )
-            self.run_command(
-                ["systemctl", "stop", "{}.service".format(service)], ignore_failure=True
-            )
+        # 'disable --now' also stops the units, and systemctl accepts
+        # multiple of them - one invocation for all four services
+        services = [
+            "{}.service".format(service)
+            for service in ("rdisc", "kdump", "libvirt-guests", "salt-minion")
+        ]
+        self.run_command(
+            ["systemctl", "disable", "--now"] + services,
+            ignore_failure=True,
+            capture_stdout=False,
+        )
 
 
 class SetDefaultTemplateTask(BaseQubesTask):
@@ -231,30 +288,30 @@ class ConfigureDefaultQubesTask(BaseQubesTask):
     def name(self):
         return "Executing qubes configuration"
 
+    # which salt states each selected option enables, in application order
+    STATE_TABLE = (
+        ("system_vms", ("qvm.sys-net", "qvm.sys-firewall", "qvm.default-dispvm")),
+        (
+            "disp_firewallvm_and_usbvm",
+            ("pillar.qvm.disposable-sys-firewall", "pillar.qvm.disposable-sys-usb"),
+        ),
+        ("disp_netvm", ("pillar.qvm.disposable-sys-net",)),
+        ("default_vms", ("qvm.personal", "qvm.work", "qvm.untrusted", "qvm.vault")),
+        ("whonix_vms", ("qvm.sys-whonix", "qvm.anon-whonix")),
+        ("whonix_default", ("qvm.updates-via-whonix",)),
+        ("usbvm", ("qvm.sys-usb",)),
+        ("usbvm_with_netvm", ("pillar.qvm.sys-net-as-usbvm",)),
+        ("allow_usb_mouse", ("pillar.qvm.sys-usb-allow-mouse",)),
+        ("allow_usb_keyboard", ("pillar.qvm.usb-keyboard",)),
+    )
+
     def run(self):
-        states = []
-        if self.system_vms:
-            states.extend(("qvm.sys-net", "qvm.sys-firewall", "qvm.default-dispvm"))
-        if self.disp_firewallvm_and_usbvm:
-            states.extend(
-                ("pillar.qvm.disposable-sys-firewall", "pillar.qvm.disposable-sys-usb")
-            )
-        if self.disp_netvm:
-            states.append("pillar.qvm.disposable-sys-net")
-        if self.default_vms:
-            states.extend(("qvm.personal", "qvm.work", "qvm.untrusted", "qvm.vault"))
-        if self.whonix_vms:
-            states.extend(("qvm.sys-whonix", "qvm.anon-whonix"))
-        if self.whonix_default:
-            states.append("qvm.updates-via-whonix")
-        if self.usbvm:
-            states.append("qvm.sys-usb")
-        if self.usbvm_with_netvm:
-            states.append("pillar.qvm.sys-net-as-usbvm")
-        if self.allow_usb_mouse:
-            states.append("pillar.qvm.sys-usb-allow-mouse")
-        if self.allow_usb_keyboard:
-            states.append("pillar.qvm.usb-keyboard")
+        states = [
+            state
+            for option, option_states in self.STATE_TABLE
+            if getattr(self, option)
+            for state in option_states
+        ]
 
         try:
             # get rid of initial entries (from package installation time)
@@ -263,26 +320,42 @@ class ConfigureDefaultQubesTask(BaseQubesTask):
             pass
 
         # Refresh minion configuration to make sure all installed formulas are included
-        self.run_command(["qubesctl", "saltutil.clear_cache"])
-        self.run_command(["qubesctl", "saltutil.sync_all"])
+        self.run_command(["qubesctl", "saltutil.clear_cache"], capture_stdout=False)
+        self.run_command(["qubesctl", "saltutil.sync_all"], capture_stdout=False)
 
-        for state in states:
-            print("Setting up state: {}".format(state))
-            if state.startswith("pillar."):
-                self.run_command(
-                    ["qubesctl", "top.enable", state[len("pillar.") :], "pillar=True"]
-                )
-            else:
-                self.run_command(["qubesctl", "top.enable", state])
+        # each qubesctl invocation cold-starts salt; top.enable/top.disable
+        # accept multiple states, so batch them per pillar/non-pillar kind
+        pillar_states = [
+            state[len("pillar.") :] for state in states if state.startswith("pillar.")
+        ]
+        regular_states = [
+            state for state in states if not state.startswith("pillar.")
+        ]
+
+        if regular_states:
+            print("Setting up states: {}".format(" ".join(regular_states)))
+            self.run_command(
+                ["qubesctl", "top.enable"] + regular_states, capture_stdout=False
+            )
+        if pillar_states:
+            print("Setting up pillar states: {}".format(" ".join(pillar_states)))
+            self.run_command(
+                ["qubesctl", "top.enable"] + pillar_states + ["pillar=True"],
+                capture_stdout=False,
+            )
 
         try:
-            self.run_command(["qubesctl", "--all", "state.highstate"])
+            self.run_command(
+                ["qubesctl", "--all", "state.highstate"], capture_stdout=False
+            )
             # After successful call disable all the states to not leave them
             # enabled, to not interfere with later user changes (like assigning
             # additional PCI devices)
-            for state in states:
-                if not state.startswith("pillar."):
-                    self.run_command(["qubesctl", "top.disable", state])
+            if regular_states:
+                self.run_command(
+                    ["qubesctl", "top.disable"] + regular_states,
+                    capture_stdout=False,
+                )
         except Exception:
             raise Exception(
                 (
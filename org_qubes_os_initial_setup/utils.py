@@ -16,8 +16,10 @@
 #
 # You should have received a copy of the GNU General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
-import glob
+import functools
+import itertools
 import os
+import re
 import subprocess
 
 import pyudev
@@ -26,26 +28,34 @@ from org_qubes_os_initial_setup.constants import TEMPLATES_RPM_PATH
 
 # dict[str, tuple(version, filename, alias, full-name)]
 templates_cache = {}
+# st_mtime_ns of TEMPLATES_RPM_PATH when the cache was built (0 when the
+# directory was missing); a change invalidates the cache
+_templates_cache_mtime = None
 
 
-def _template_alias_parts(template):
+# qubes-template-<name>-<pkgver>-<build>.<arch>.rpm - one match extracts
+# <name> instead of prefix/suffix checks plus repeated rsplit passes
+_TEMPLATE_RPM_RE = re.compile(r"^qubes-template-(?P<name>.+)-[^-]+-[^-]+\.[^.]+\.rpm$")
+
+
+# display casing for flavor parts
+_FLAVOR_CASE = {"xfce": "Xfce", "kde": "KDE", "gnome": "GNOME"}
+
+
+def _template_alias_parts(parts):
     # yield parts that are to be included in the final alias (to be joined
-    # with a space)
+    # with a space); parts come pre-split, cased like str.capitalize() on
+    # the joined name
     version_found = False
-    for part in template.capitalize().split("-"):
-        if part[0].isdigit():
+    for i, part in enumerate(parts):
+        part = part.capitalize() if i == 0 else part.lower()
+        if part[:1].isdigit():
             if version_found:
                 # only first numer is considered a template version
                 continue
             version_found = True
         # adjust cases for flavors
-        if part == "xfce":
-            part = "Xfce"
-        elif part == "kde":
-            part = "KDE"
-        elif part == "gnome":
-            part = "GNOME"
-        yield part
+        yield _FLAVOR_CASE.get(part, part)
 
 
 def update_template_list():
@@ -53,20 +63,15 @@ def update_template_list():
     templates = {}
     try:
         for fname in os.listdir(TEMPLATES_RPM_PATH):
-            if not fname.startswith("qubes-template-"):
-                continue
-            if not fname.endswith(".rpm"):
+            match = _TEMPLATE_RPM_RE.match(fname)
+            if match is None:
                 continue
-            tname = fname[len("qubes-template-") :]
-            # then remove .noarch.rpm (also when different arch is set)
-            tname = tname.rsplit(".", 2)[0]
-            # then remove package version (-4.2.0-202301020304
-            tname = tname.rsplit("-", 2)[0]
+            tname = match.group("name")
             parts = tname.split("-")
             # now drop numeric parts
             name_flavor = "-".join(p for p in parts if p[0].isalpha())
             version = [p for p in parts if p[0].isdigit()][0]
-            alias = " ".join(_template_alias_parts(tname))
+            alias = " ".join(_template_alias_parts(parts))
             templates[name_flavor] = (version, fname, alias, tname)
     except FileNotFoundError:
         # don't crash if no templates are available at all
@@ -74,39 +79,50 @@ def update_template_list():
     templates_cache = templates
 
 
-def get_template_alias(template):
-    if not templates_cache:
+def _get_templates():
+    # one directory scan shared by all the template probes below, redone
+    # only when the directory itself changes (also settles the "cache
+    # stays empty" rescan-per-call case of an empty directory)
+    global _templates_cache_mtime
+    try:
+        mtime = os.stat(TEMPLATES_RPM_PATH).st_mtime_ns
+    except OSError:
+        mtime = 0
+    if mtime != _templates_cache_mtime:
+        _templates_cache_mtime = mtime
         update_template_list()
-    if template in templates_cache:
-        return templates_cache[template][2]
+    return templates_cache
+
+
+def get_template_alias(template):
+    templates = _get_templates()
+    if template in templates:
+        return templates[template][2]
     return None
 
 
 def get_template_rpm(template):
-    if not templates_cache:
-        update_template_list()
-    if template in templates_cache:
-        return TEMPLATES_RPM_PATH + templates_cache[template][1]
+    templates = _get_templates()
+    if template in templates:
+        return TEMPLATES_RPM_PATH + templates[template][1]
     return None
 
 
 def is_template_rpm_available(template):
-    return bool(get_template_rpm(template))
+    return template in _get_templates()
 
 
 def get_template_version(template):
-    if not templates_cache:
-        update_template_list()
-    if template in templates_cache:
-        return templates_cache[template][0]
+    templates = _get_templates()
+    if template in templates:
+        return templates[template][0]
     return None
 
 
 def get_template_name(template):
-    if not templates_cache:
-        update_template_list()
-    if template in templates_cache:
-        return templates_cache[template][3]
+    templates = _get_templates()
+    if template in templates:
+        return templates[template][3]
     return None
 
 
@@ -115,9 +131,32 @@ def get_templates_list():
     return [(name, info[2]) for name, info in templates_cache.items()]
 
 
+# opening the rpmdb is the expensive part of an in-process query; keep
+# one TransactionSet around for repeated lookups
+_rpm_transaction_set = None
+
+
 def is_package_installed(pkgname):
-    pkglist = subprocess.check_output(["rpm", "-qa", pkgname])
-    return bool(pkglist)
+    # rpm bindings do an indexed Name lookup in-process; 'rpm -qa' would
+    # fork and scan every installed header
+    global _rpm_transaction_set
+    if _rpm_transaction_set is None:
+        import rpm
+
+        _rpm_transaction_set = rpm.TransactionSet()
+    return bool(_rpm_transaction_set.dbMatch("name", pkgname).count())
+
+
+# constructing a Context mmaps the udev hwdb and opens a netlink socket;
+# share a single one across the helpers below
+_udev_context = None
+
+
+def _get_udev_context():
+    global _udev_context
+    if _udev_context is None:
+        _udev_context = pyudev.Context()
+    return _udev_context
 
 
 def is_usb_device(device: pyudev.Device):
@@ -129,55 +168,128 @@ def is_usb_device(device: pyudev.Device):
     return False
 
 
+# ID_PATH prefixes of USB controllers staying in dom0 (rd.qubes.dom0_usb);
+# parsed lazily once - the kernel command line cannot change while we run
+_dom0_usb_prefixes = None
+
+
+def _get_dom0_usb_prefixes():
+    global _dom0_usb_prefixes
+    if _dom0_usb_prefixes is None:
+        controllers = []
+        with open("/proc/cmdline") as cmdline:
+            for opt in cmdline.read().split():
+                if opt.startswith("rd.qubes.dom0_usb="):
+                    controllers.extend(opt.split("=", 1)[1].split(","))
+        _dom0_usb_prefixes = tuple(
+            "pci-0000:{}-".format(controller) for controller in controllers
+        )
+    return _dom0_usb_prefixes
+
+
+def _is_usb_device_cached(device, cache):
+    # same answer as is_usb_device, but remembers the verdict ("this node
+    # or one of its ancestors is USB") for every sysfs node visited, so
+    # ancestors shared between input devices are only walked once
+    chain = []
+    verdict = None
+    for node in itertools.chain((device,), device.ancestors):
+        path = node.sys_path
+        if path in cache:
+            verdict = cache[path]
+            break
+        chain.append(path)
+        if node.get("ID_USB_INTERFACES", False):
+            verdict = True
+            break
+    if verdict is None:
+        verdict = False
+    for path in chain:
+        cache[path] = verdict
+    return verdict
+
+
 def usb_keyboard_present():
-    context = pyudev.Context()
+    context = _get_udev_context()
     keyboards = context.list_devices(subsystem="input", ID_INPUT_KEYBOARD="1")
     # allow sys-usb even if USB keyboard is present, as long as it's connected
     # to a controller that remains in dom0
-    dom0_controllers = []
-    with open("/proc/cmdline") as cmdline:
-        for opt in cmdline.read().split():
-            if opt.startswith("rd.qubes.dom0_usb="):
-                dom0_controllers.extend(opt.split("=", 1)[1].split(","))
+    dom0_prefixes = _get_dom0_usb_prefixes()
     usb_keyboards = []
+    ancestry_cache = {}
     for kbd in keyboards:
-        if not is_usb_device(kbd):
+        if not _is_usb_device_cached(kbd, ancestry_cache):
+            continue
+        # startswith on a tuple matches all prefixes in one C call;
+        # an empty tuple never matches
+        if kbd.get("ID_PATH", "").startswith(dom0_prefixes):
             continue
-        for dom0_usb in dom0_controllers:
-            if kbd.get("ID_PATH", "").startswith("pci-0000:" + dom0_usb + "-"):
-                break
-        else:
-            usb_keyboards.append(
-                "{} {}".format(kbd.get("ID_VENDOR"), kbd.get("ID_MODEL"))
-            )
+        usb_keyboards.append(
+            "{} {}".format(kbd.get("ID_VENDOR"), kbd.get("ID_MODEL"))
+        )
     return usb_keyboards
 
 
+def _is_usb_blockdev(major, minor):
+    # the sysfs device path of anything hanging off a USB controller has a
+    # /usbN/ component; one readlink instead of building a udev device
+    try:
+        path = os.readlink("/sys/dev/block/{}:{}".format(major, minor))
+    except OSError:
+        return False
+    return "/usb" in path
+
+
 def started_from_usb():
-    def get_all_used_devices(dev):
-        stat = os.stat(dev)
-        if stat.st_rdev:
-            # XXX any better idea how to handle device-mapper?
-            sysfs_slaves = "/sys/dev/block/{}:{}/slaves".format(
-                os.major(stat.st_rdev), os.minor(stat.st_rdev)
-            )
-            if os.path.exists(sysfs_slaves):
-                for slave_dev in os.listdir(sysfs_slaves):
-                    for d in get_all_used_devices("/dev/{}".format(slave_dev)):
-                        yield d
-            else:
-                yield dev
-
-    context = pyudev.Context()
-    mounts = open("/proc/mounts").readlines()
-    for mount in mounts:
-        device = mount.split(" ")[0]
-        if not os.path.exists(device):
+    # mountinfo field 3 carries the mount's device number directly, so no
+    # path lookup or stat on the source device is needed; major 0 means a
+    # virtual filesystem
+    devnums = set()
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            major, minor = fields[2].split(":")
+            if major != "0":
+                devnums.add((int(major), int(minor)))
+                continue
+            # filesystems with an anonymous device number (e.g. btrfs)
+            # may still sit on a real block device, named as the mount
+            # source after the optional-fields separator
+            source = fields[fields.index("-") + 2]
+            if not source.startswith("/"):
+                continue
+            try:
+                source_stat = os.stat(source)
+            except OSError:
+                continue
+            if source_stat.st_rdev:
+                devnums.add(
+                    (os.major(source_stat.st_rdev), os.minor(source_stat.st_rdev))
+                )
+
+    # XXX any better idea how to handle device-mapper?
+    # devices already checked - device-mapper slaves are commonly shared
+    # between mounts (LVM root and home on one PV)
+    checked = set()
+    stack = list(devnums)
+    while stack:
+        major, minor = stack.pop()
+        if (major, minor) in checked:
             continue
-        for dev in get_all_used_devices(device):
-            udev_info = pyudev.Devices.from_device_file(context, dev)
-            if is_usb_device(udev_info):
+        checked.add((major, minor))
+        sysfs_slaves = "/sys/dev/block/{}:{}/slaves".format(major, minor)
+        try:
+            slaves = os.listdir(sysfs_slaves)
+        except FileNotFoundError:
+            if _is_usb_blockdev(major, minor):
                 return True
+            continue
+        for slave in slaves:
+            # each slave entry links to the slave device's sysfs dir,
+            # whose 'dev' attribute holds its device number
+            with open("{}/{}/dev".format(sysfs_slaves, slave)) as dev_attr:
+                slave_major, slave_minor = dev_attr.read().strip().split(":")
+            stack.append((int(slave_major), int(slave_minor)))
 
     return False
 
@@ -188,45 +300,46 @@ def get_default_tpool():
     fs_major = (fs_stat.st_dev & 0xFF00) >> 8
     fs_minor = fs_stat.st_dev & 0xFF
 
+    # a single lvs call tells us which LV the root filesystem lives on
+    # (by kernel device number), which thin pool backs it, and which LVs
+    # exist - no dmsetup, no sysfs name parsing, no second lvs probe
     try:
-        root_table = subprocess.check_output(
-            ["dmsetup", "-j", str(fs_major), "-m", str(fs_minor), "table"],
+        lvs_output = subprocess.check_output(
+            [
+                "lvs",
+                "--noheadings",
+                "--separator",
+                "|",
+                "-o",
+                "vg_name,lv_name,pool_lv,lv_kernel_major,lv_kernel_minor",
+            ],
             stderr=subprocess.DEVNULL,
         )
     except subprocess.CalledProcessError:
         return None
 
-    _start, _sectors, target_type, target_args = root_table.decode().split(" ", 3)
-    if target_type not in ("thin", "linear"):
+    volume_group = None
+    thin_pool = None
+    existing_lvs = set()
+    for line in lvs_output.decode().splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) != 5:
+            continue
+        vg_name, lv_name, pool_lv, kernel_major, kernel_minor = fields
+        existing_lvs.add((vg_name, lv_name))
+        if kernel_major == str(fs_major) and kernel_minor == str(fs_minor):
+            volume_group = vg_name
+            thin_pool = pool_lv or None
+
+    if volume_group is None:
+        # root filesystem is not on LVM
         return None
 
     create = False
-    lower_devnum, _args = target_args.split(" ")
-    with open("/sys/dev/block/{}/dm/name".format(lower_devnum), "r") as lower_devname_f:
-        lower_devname = lower_devname_f.read().rstrip("\n")
-    if lower_devname.endswith("-tpool"):
-        # LVM replaces '-' by '--' if name contains
-        # a hyphen
-        lower_devname = lower_devname.replace("--", "=")
-        volume_group, thin_pool, _tpool = lower_devname.rsplit("-", 2)
-        volume_group = volume_group.replace("=", "-")
-        thin_pool = thin_pool.replace("=", "-")
-    else:
-        lower_devname = lower_devname.replace("--", "=")
-        volume_group, _lv_name = lower_devname.rsplit("-", 1)
-        volume_group = volume_group.replace("=", "-")
-        thin_pool = None
-
     if thin_pool in (None, "root-pool"):
-        thin_pool = "vm-pool"
         # search for "vm-pool" in the same VG
-        try:
-            cmd = ["lvs", "--noheadings", "{}/vm-pool".format(volume_group)]
-            subprocess.check_call(
-                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-            )
-        except subprocess.CalledProcessError:
-            create = True
+        thin_pool = "vm-pool"
+        create = (volume_group, "vm-pool") not in existing_lvs
 
     if volume_group and thin_pool:
         return volume_group, thin_pool, create
@@ -234,11 +347,18 @@ def get_default_tpool():
     return None
 
 
+@functools.lru_cache(maxsize=None)
 def to_camel_case(name: str):
+    # called for every CamelCaseWrap attribute access and each watched
+    # property; the set of names is small and fixed
     return name.title().replace("_", "")
 
 
 class CamelCaseWrap:
+    # every attribute access goes through __getattr__/__setattr__; avoid
+    # the per-instance dict, the proxy holds nothing but the model
+    __slots__ = ("_model",)
+
     def __init__(self, model):
         self._model = model
 